@@ -145,6 +145,13 @@ def main():
     opts["opt_beta1"] = FLAGS.adam_beta1
     opts['batch_norm_eps'] = 1e-05
     opts['batch_norm_decay'] = 0.9
+    opts['xla_jit'] = False # Compile POT forward pass with XLA
+    opts['fp16'] = False # Run POT encoder and decoder in half precision
+    opts['fp16_loss_scale'] = 128.
+    opts['gpu_mem_frac'] = 0.95 # POT session settings
+    opts['intra_op_threads'] = 0 # 0 lets TF decide
+    opts['inter_op_threads'] = 2
+    opts['loss_every'] = 10 # Fetch POT losses every so many steps
 
     if opts['e_is_random']:
         assert opts['latent_space_distr'] == 'normal',\
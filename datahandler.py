@@ -17,6 +17,7 @@ import PIL
 from utils import ArraySaver
 from PIL import Image
 import sys
+import threading
 
 
 def _data_dir(opts):
@@ -103,7 +104,8 @@ class Data(object):
         self.dict_loaded = None
         self.loaded = None
         if isinstance(X, np.ndarray):
-            self.X = X
+            # C-contiguous float32, so that minibatches are plain row copies
+            self.X = np.ascontiguousarray(X, dtype=np.float32)
             self.shape = X.shape
         else:
             assert isinstance(data_dir, str), 'Data directory not provided'
@@ -112,6 +114,9 @@ class Data(object):
             self.paths = paths[:]
             self.dict_loaded = {} if dict_loaded is None else dict_loaded
             self.loaded = [] if loaded is None else loaded
+            # Points may be read from several threads, e.g. by the input
+            # pipeline of POT, guard the cache of loaded points
+            self._lock = threading.Lock()
             self.crop_style = opts['celebA_crop']
             self.dataset_name = opts['dataset']
             self.shape = (len(self.paths), None, None, None)
@@ -148,30 +153,45 @@ class Data(object):
             else:
                 print type(key)
                 raise Exception('This type of indexing yet not supported for the dataset')
-            res = []
-            new_keys = []
-            new_points = []
-            for key in keys:
-                if key in self.dict_loaded:
-                    idx = self.dict_loaded[key]
-                    res.append(self.loaded[idx])
-                else:
-                    if self.dataset_name == 'celebA':
-                        point = self._read_celeba_image(self.data_dir, self.paths[key])
+            with self._lock:
+                res = []
+                new_keys = []
+                new_points = []
+                for key in keys:
+                    if key in self.dict_loaded:
+                        idx = self.dict_loaded[key]
+                        res.append(self.loaded[idx])
                     else:
-                        raise Exception('Disc read for this dataset not implemented yet...')
-                    if self.normalize:
-                        point = (point - 0.5) * 2.
-                    res.append(point)
-                    new_points.append(point)
-                    new_keys.append(key)
-            n = len(self.loaded)
-            cnt = 0
-            for key in new_keys:
-                self.dict_loaded[key] = n + cnt
-                cnt += 1
-            self.loaded.extend(new_points)
-            return np.array(res)
+                        if self.dataset_name == 'celebA':
+                            point = self._read_celeba_image(self.data_dir, self.paths[key])
+                        else:
+                            raise Exception('Disc read for this dataset not implemented yet...')
+                        if self.normalize:
+                            point = (point - 0.5) * 2.
+                        res.append(point)
+                        new_points.append(point)
+                        new_keys.append(key)
+                n = len(self.loaded)
+                cnt = 0
+                for key in new_keys:
+                    self.dict_loaded[key] = n + cnt
+                    cnt += 1
+                self.loaded.extend(new_points)
+            return np.array(res, dtype=np.float32)
+
+    def take(self, keys, out=None):
+        """Same as self[keys] for an array of keys.
+
+        If out is given, the points are written into it and it is returned.
+        """
+        if isinstance(self.X, np.ndarray):
+            # Keys are valid indices, 'clip' avoids buffering of out
+            return np.take(self.X, keys, axis=0, out=out, mode='clip')
+        res = self[keys]
+        if out is None:
+            return res
+        out[...] = res
+        return out
 
     def _read_celeba_image(self, data_dir, filename):
         width = 178
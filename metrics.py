@@ -27,6 +27,8 @@ class Metrics(object):
 
     def __init__(self):
         self.l2s = None
+        # Training steps of the l2s values, None for one value per step
+        self.l2s_steps = None
         self.losses_match = None
         self.losses_rec = None
         self.Qz = None
@@ -576,7 +578,10 @@ class Metrics(object):
             else:
                 plt.subplot(gs[1,0])
             cutoff = 1e2
-            x = np.arange(1, len(self.l2s) + 1)
+            if self.l2s_steps is None:
+                x = np.arange(1, len(self.l2s) + 1)
+            else:
+                x = np.array(self.l2s_steps)
             y = np.array([el if abs(el) < cutoff else el / abs(el) * cutoff for el in self.l2s])
             plt.plot(x, y, color='red', label='loss')
             if self.losses_match is not None and self.losses_rec is not None:
@@ -13,15 +13,22 @@ import logging
 def lrelu(x, leak=0.3):
     return tf.maximum(x, leak * x)
 
-def batch_norm(opts, _input, is_train, reuse, scope, scale=True):
+def batch_norm(opts, _input, is_train, reuse, scope, scale=True, fused=False):
     """Batch normalization based on tf.contrib.layers.
 
+    Set fused=True to use the single-kernel implementation, which only
+    supports 4d inputs. Half precision inputs are normalized in float32.
+
     """
-    return tf.contrib.layers.batch_norm(
+    dtype = _input.dtype
+    if dtype == tf.float16:
+        _input = tf.cast(_input, tf.float32)
+    res = tf.contrib.layers.batch_norm(
         _input, center=True, scale=scale,
         epsilon=opts['batch_norm_eps'], decay=opts['batch_norm_decay'],
         is_training=is_train, reuse=reuse, updates_collections=None,
-        scope=scope, fused=False)
+        scope=scope, fused=fused)
+    return tf.cast(res, dtype)
 
 def upsample_nn(input_, new_size, scope=None, reuse=None):
     """NN up-sampling
@@ -41,7 +48,8 @@ def downsample(input_, d_h=2, d_w=2, conv_filters_dim=None, scope=None, reuse=No
 
     return result
 
-def linear(opts, input_, output_dim, scope=None, init='normal', reuse=None):
+def linear(opts, input_, output_dim, scope=None, init='normal', reuse=None,
+           activation=None):
     """Fully connected linear layer.
 
     Args:
@@ -50,6 +58,9 @@ def linear(opts, input_, output_dim, scope=None, init='normal', reuse=None):
             we will stretch them out in [numpoints, prod(dims)].
         output_dim: number of features for the output. I.e., the second
             dimensionality of the matrix W.
+        activation: optional nonlinearity applied right after the bias,
+            e.g. tf.nn.relu. Graph optimizers can then fuse
+            matmul + bias + activation into one kernel.
     """
 
     stddev = opts['init_std']
@@ -77,9 +88,15 @@ def linear(opts, input_, output_dim, scope=None, init='normal', reuse=None):
         bias = tf.get_variable(
             "b", [output_dim],
             initializer=tf.constant_initializer(bias_start))
+        if input_.dtype == tf.float16:
+            # float32 master weights, half precision compute
+            matrix = tf.cast(matrix, tf.float16)
+            bias = tf.cast(bias, tf.float16)
 
-
-    return tf.matmul(input_, matrix) + bias
+    res = tf.nn.bias_add(tf.matmul(input_, matrix), bias)
+    if activation is not None:
+        res = activation(res)
+    return res
 
 
 def conv2d(opts, input_, output_dim, d_h=2, d_w=2, scope=None,
@@ -107,10 +124,14 @@ def conv2d(opts, input_, output_dim, d_h=2, d_w=2, scope=None,
             initializer=tf.truncated_normal_initializer(stddev=stddev))
         if l2_norm:
             w = tf.nn.l2_normalize(w, 2)
-        conv = tf.nn.conv2d(input_, w, strides=[1, d_h, d_w, 1], padding=padding)
         biases = tf.get_variable(
             'b', [output_dim],
             initializer=tf.constant_initializer(bias_start))
+        if input_.dtype == tf.float16:
+            # float32 master weights, half precision compute
+            w = tf.cast(w, tf.float16)
+            biases = tf.cast(biases, tf.float16)
+        conv = tf.nn.conv2d(input_, w, strides=[1, d_h, d_w, 1], padding=padding)
         conv = tf.nn.bias_add(conv, biases)
 
     return conv
@@ -134,12 +155,16 @@ def deconv2d(opts, input_, output_shape, d_h=2, d_w=2, scope=None, conv_filters_
         w = tf.get_variable(
             'filter', [k_h, k_w, output_shape[-1], shape[-1]],
             initializer=tf.random_normal_initializer(stddev=stddev))
-        deconv = tf.nn.conv2d_transpose(
-            input_, w, output_shape=output_shape,
-            strides=[1, d_h, d_w, 1], padding=padding)
         biases = tf.get_variable(
             'b', [output_shape[-1]],
             initializer=tf.constant_initializer(0.0))
+        if input_.dtype == tf.float16:
+            # float32 master weights, half precision compute
+            w = tf.cast(w, tf.float16)
+            biases = tf.cast(biases, tf.float16)
+        deconv = tf.nn.conv2d_transpose(
+            input_, w, output_shape=output_shape,
+            strides=[1, d_h, d_w, 1], padding=padding)
         deconv = tf.nn.bias_add(deconv, biases)
 
 
@@ -10,6 +10,7 @@ import logging
 import os
 import time
 import tensorflow as tf
+from tensorflow.contrib.compiler import jit
 import utils
 from utils import ProgressBar
 from utils import TQDM
@@ -66,7 +67,7 @@ def vgg_16(inputs,
 def compute_moments(_inputs, moments=[2, 3]):
     """From an image input, compute moments"""
     _inputs_sq = tf.square(_inputs)
-    _inputs_cube = tf.pow(_inputs, 3)
+    _inputs_cube = _inputs_sq * _inputs
     height = int(_inputs.get_shape()[1])
     width = int(_inputs.get_shape()[2])
     channels = int(_inputs.get_shape()[3])
@@ -88,7 +89,7 @@ def compute_moments(_inputs, moments=[2, 3]):
             outputs.append(var)
         if 3 in moments:
             cube = ConvFlatten(_inputs_cube, size)
-            skewness = cube - 3.0 * mean * var - tf.pow(mean, 3)  # Unnormalized
+            skewness = cube - 3.0 * mean * var - mean * tf.square(mean)  # Unnormalized
             outputs.append(skewness)
     return tf.concat(outputs, 1)
 
@@ -98,6 +99,46 @@ def prod_dim(tensor):
 def flatten(tensor):
     return tf.reshape(tensor, [-1, prod_dim(tensor)])
 
+def gaussian_cdf(values, std):
+    """CDF of the centered Gaussian with standard deviation std."""
+    return 0.5 * (1. + tf.erf(values * (1. / (std * np.sqrt(2.)))))
+
+def random_noise(opts, num):
+    """In-graph counterpart of utils.generate_noise."""
+    shape = tf.stack([num, opts['latent_space_dim']])
+    if opts['latent_space_distr'] == 'uniform':
+        return tf.random_uniform(shape, -1., 1.)
+    elif opts['latent_space_distr'] == 'normal':
+        return tf.random_normal(shape)
+    else:
+        assert False, 'Unknown latent space distribution for POT'
+
+def alias_table(weights):
+    """Vose's alias table for sampling from a discrete distribution.
+
+    Returns arrays (prob, alias), such that picking i uniformly and then
+    returning i with probability prob[i] and alias[i] otherwise samples
+    i with probability weights[i].
+    """
+    num = len(weights)
+    scaled = np.asarray(weights, dtype=np.float64) * (num / np.sum(weights))
+    prob = np.ones(num)
+    alias = np.arange(num)
+    small = [i for i in range(num) if scaled[i] < 1.]
+    large = [i for i in range(num) if scaled[i] >= 1.]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        prob[less] = scaled[less]
+        alias[less] = more
+        scaled[more] = scaled[more] + scaled[less] - 1.
+        if scaled[more] < 1.:
+            small.append(more)
+        else:
+            large.append(more)
+    # Whatever is left has probability 1 up to rounding errors
+    return prob, alias
+
 class Pot(object):
     """A base class for running individual POTs.
 
@@ -105,24 +146,52 @@ class Pot(object):
     def __init__(self, opts, data, weights):
 
         # Create a new session with session.graph = default graph
-        self._session = tf.Session()
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
+        config.gpu_options.per_process_gpu_memory_fraction = opts['gpu_mem_frac']
+        config.intra_op_parallelism_threads = opts['intra_op_threads']
+        config.inter_op_parallelism_threads = opts['inter_op_threads']
+        if opts['xla_jit']:
+            config.graph_options.optimizer_options.global_jit_level = \
+                tf.OptimizerOptions.ON_1
+        self._session = tf.Session(config=config)
         self._trained = False
         self._data = data
         self._data_weights = np.copy(weights)
+        # Alias table for weighted sampling, None for uniform weights
+        self._alias_table = None
+        if not np.allclose(self._data_weights * data.num_points, 1.):
+            self._alias_table = alias_table(self._data_weights)
         # Latent noise sampled ones to apply decoder while training
-        self._noise_for_plots = opts['pot_pz_std'] * utils.generate_noise(opts, 1000)
+        self._noise_for_plots = None
         # Placeholders
         self._real_points_ph = None
         self._noise_ph = None
         # Init ops
         self._additional_init_ops = []
         self._init_feed_dict = {}
+        # Random projections used by the Cramer-von Mises test
+        self._cramer_proj = None
+        # Reused while plotting. Only _metrics carries the Qz projections
+        # and the loss curves, _test_metrics plots plain pictures.
+        self._metrics = Metrics()
+        self._test_metrics = Metrics()
+        # Minibatches fed explicitly while training are gathered here
+        self._batch_buf = np.empty(
+            [opts['batch_size']] + list(data.data_shape), dtype=np.float32)
+        # Interleaved real points and reconstructions for the plots
+        self._merged_buf = np.empty(
+            [2 * 8 * 10] + list(data.data_shape), dtype=np.float32)
 
         # Main operations
 
         # Optimizers
 
         with self._session.as_default(), self._session.graph.as_default():
+            # Kept in the graph, so that plotting does not feed it every time
+            self._noise_for_plots = tf.constant(
+                utils.generate_noise(opts, 320, scale=opts['pot_pz_std']),
+                name='noise_for_plots')
             logging.error('Building the graph...')
             self._build_model_internal(opts)
 
@@ -194,7 +263,7 @@ class Pot(object):
         batch_size = opts['tf_run_batch_size']
         batches_num = int(np.ceil((num_points + 0.) / batch_size))
         result = []
-        for idx in xrange(batches_num):
+        for idx in range(batches_num):
             if idx == batches_num - 1:
                 if feed2 is None:
                     res = self._session.run(
@@ -261,11 +330,11 @@ class ImagePot(Pot):
         batch_size = tf.shape(noise)[0]
         num_layers = opts['g_num_layers']
         if opts['g_arch'] == 'dcgan':
-            height = output_shape[0] / 2**num_layers
-            width = output_shape[1] / 2**num_layers
+            height = output_shape[0] // 2**num_layers
+            width = output_shape[1] // 2**num_layers
         elif opts['g_arch'] == 'dcgan_mod':
-            height = output_shape[0] / 2**(num_layers-1)
-            width = output_shape[1] / 2**(num_layers-1)
+            height = output_shape[0] // 2**(num_layers-1)
+            width = output_shape[1] // 2**(num_layers-1)
         else:
             assert False
 
@@ -274,25 +343,25 @@ class ImagePot(Pot):
         h0 = tf.reshape(h0, [-1, height, width, num_units])
         h0 = tf.nn.relu(h0)
         layer_x = h0
-        for i in xrange(num_layers-1):
+        for i in range(num_layers-1):
             scale = 2**(i+1)
             if opts['g_stride1_deconv']:
                 # Sylvain, I'm worried about this part!
-                _out_shape = [batch_size, height * scale / 2,
-                              width * scale / 2, num_units / scale * 2]
+                _out_shape = [batch_size, height * scale // 2,
+                              width * scale // 2, num_units // scale * 2]
                 layer_x = ops.deconv2d(
                     opts, layer_x, _out_shape, d_h=1, d_w=1,
                     scope='h%d_deconv_1x1' % i)
                 layer_x = tf.nn.relu(layer_x)
-            _out_shape = [batch_size, height * scale, width * scale, num_units / scale]
+            _out_shape = [batch_size, height * scale, width * scale, num_units // scale]
             layer_x = ops.deconv2d(opts, layer_x, _out_shape, scope='h%d_deconv' % i)
             if opts['batch_norm']:
-                layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bn%d' % i)
+                layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bn%d' % i, fused=True)
             layer_x = tf.nn.relu(layer_x)
             if opts['dropout']:
                 _keep_prob = tf.minimum(
                     1., 0.9 - (0.9 - keep_prob) * float(i + 1) / (num_layers - 1))
-                layer_x = tf.nn.dropout(layer_x, _keep_prob)
+                layer_x = tf.nn.dropout(layer_x, tf.cast(_keep_prob, layer_x.dtype))
 
         _out_shape = [batch_size] + list(output_shape)
         if opts['g_arch'] == 'dcgan':
@@ -322,7 +391,7 @@ class ImagePot(Pot):
             opts, noise, num_units * 8 * 8, scope='h0_lin')
         h0 = tf.reshape(h0, [-1, 8, 8, num_units])
         layer_x = h0
-        for i in xrange(num_layers):
+        for i in range(num_layers):
             if i % 3 < 2:
                 # Don't change resolution
                 layer_x = ops.conv2d(opts, layer_x, num_units, d_h=1, d_w=1, scope='h%d_conv' % i)
@@ -330,7 +399,7 @@ class ImagePot(Pot):
             else:
                 if i != num_layers - 1:
                     # Upsampling by factor of 2 with NN
-                    scale = 2 ** (i / 3 + 1)
+                    scale = 2 ** (i // 3 + 1)
                     layer_x = ops.upsample_nn(layer_x, [scale * 8, scale * 8],
                                               scope='h%d_upsample' % i, reuse=reuse)
                     # Skip connection
@@ -354,20 +423,22 @@ class ImagePot(Pot):
         data_height = output_shape[0]
         data_width = output_shape[1]
         data_channels = output_shape[2]
-        height = data_height / 2**num_layers
-        width = data_width / 2**num_layers
+        height = data_height // 2**num_layers
+        width = data_width // 2**num_layers
 
         h0 = ops.linear(
             opts, noise, num_units * height * width, scope='h0_lin')
         h0 = tf.reshape(h0, [-1, height, width, num_units])
         h0 = tf.nn.relu(h0)
         layer_x = h0
-        for i in xrange(num_layers-1):
-            layer_x = tf.image.resize_nearest_neighbor(layer_x, (2 * height, 2 * width))
-            layer_x = ops.conv2d(opts, layer_x, num_units / 2, d_h=1, d_w=1, scope='conv2d_%d' % i)
+        for i in range(num_layers-1):
+            # Upsampling by factor of 2 with a pixel shuffle: the conv
+            # runs at low resolution and produces 4x the output channels.
+            layer_x = ops.conv2d(opts, layer_x, 4 * (num_units // 2), d_h=1, d_w=1, scope='conv2d_%d' % i)
+            layer_x = tf.depth_to_space(layer_x, 2)
             height *= 2
             width *= 2
-            num_units /= 2
+            num_units //= 2
 
             if opts['g_3x3_conv'] > 0:
                 before = layer_x
@@ -379,15 +450,15 @@ class ImagePot(Pot):
                 layer_x += before  # Residual connection.
 
             if opts['batch_norm']:
-                layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bn%d' % i)
+                layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bn%d' % i, fused=True)
             layer_x = tf.nn.relu(layer_x)
             if opts['dropout']:
                 _keep_prob = tf.minimum(
                     1., 0.9 - (0.9 - keep_prob) * float(i + 1) / (num_layers - 1))
-                layer_x = tf.nn.dropout(layer_x, _keep_prob)
+                layer_x = tf.nn.dropout(layer_x, tf.cast(_keep_prob, layer_x.dtype))
 
-        layer_x = tf.image.resize_nearest_neighbor(layer_x, (2 * height, 2 * width))
-        layer_x = ops.conv2d(opts, layer_x, data_channels, d_h=1, d_w=1, scope='last_conv2d_%d' % i)
+        layer_x = ops.conv2d(opts, layer_x, 4 * data_channels, d_h=1, d_w=1, scope='last_conv2d_%d' % i)
+        layer_x = tf.depth_to_space(layer_x, 2)
 
         if opts['input_normalize_sym']:
             return tf.nn.tanh(layer_x)
@@ -408,11 +479,11 @@ class ImagePot(Pot):
         num_units = opts['g_num_filters']
         layer_params = []
         layer_params.append([4, 1, num_units])
-        layer_params.append([4, 2, num_units / 2])
-        layer_params.append([4, 1, num_units / 4])
-        layer_params.append([4, 2, num_units / 8])
-        layer_params.append([5, 1, num_units / 8])
-        # For convolution: (n - k) / stride + 1 = s
+        layer_params.append([4, 2, num_units // 2])
+        layer_params.append([4, 1, num_units // 4])
+        layer_params.append([4, 2, num_units // 8])
+        layer_params.append([5, 1, num_units // 8])
+        # For convolution: (n - k) // stride + 1 = s
         # For transposed: (s - 1) * stride + k = n
         layer_x = noise
         height = 1
@@ -424,15 +495,15 @@ class ImagePot(Pot):
                 opts, layer_x, [batch_size, height, width, channels], d_h=stride, d_w=stride,
                 scope='h%d_deconv' % i, conv_filters_dim=kernel, padding='VALID')
             if opts['batch_norm']:
-                layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bn%d' % i)
+                layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bn%d' % i, fused=True)
             layer_x = ops.lrelu(layer_x, 0.1)
         assert height == data_height
         assert width == data_width
 
         # Then two 1x1 convolutions.
-        layer_x = ops.conv2d(opts, layer_x, num_units / 8, d_h=1, d_w=1, scope='conv2d_1x1', conv_filters_dim=1)
+        layer_x = ops.conv2d(opts, layer_x, num_units // 8, d_h=1, d_w=1, scope='conv2d_1x1', conv_filters_dim=1)
         if opts['batch_norm']:
-            layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bnlast')
+            layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bnlast', fused=True)
         layer_x = ops.lrelu(layer_x, 0.1)
         layer_x = ops.conv2d(opts, layer_x, data_channels, d_h=1, d_w=1, scope='conv2d_1x1_2', conv_filters_dim=1)
 
@@ -444,8 +515,16 @@ class ImagePot(Pot):
     def generator(self, opts, noise, is_training=False, reuse=False, keep_prob=1.):
         """ Decoder actually.
 
+        With opts['fp16'] the net runs in half precision, while the
+        output is always float32.
         """
+        if not opts['fp16']:
+            return self._generator_net(opts, noise, is_training, reuse, keep_prob)
+        res = self._generator_net(
+            opts, tf.cast(noise, tf.float16), is_training, reuse, keep_prob)
+        return tf.cast(res, tf.float32)
 
+    def _generator_net(self, opts, noise, is_training, reuse, keep_prob):
         output_shape = self._data.data_shape
         num_units = opts['g_num_filters']
 
@@ -454,8 +533,8 @@ class ImagePot(Pot):
             if opts['g_arch'] == 'mlp':
                 layer_x = noise
                 for i in range(opts['g_num_layers']):
-                    layer_x = ops.linear(opts, layer_x, num_units, 'h%d_lin' % i)
-                    layer_x = tf.nn.relu(layer_x)
+                    layer_x = ops.linear(opts, layer_x, num_units, 'h%d_lin' % i,
+                                         activation=tf.nn.relu)
                     if opts['batch_norm']:
                         layer_x = ops.batch_norm(
                             opts, layer_x, is_training, reuse, scope='bn%d' % i)
@@ -487,8 +566,8 @@ class ImagePot(Pot):
         with tf.variable_scope(prefix, reuse=reuse):
             hi = input_
             for i in range(num_layers):
-                hi = ops.linear(opts, hi, num_units, scope='h%d_lin' % (i+1))
-                hi = tf.nn.relu(hi)
+                hi = ops.linear(opts, hi, num_units, scope='h%d_lin' % (i+1),
+                                activation=tf.nn.relu)
             hi = ops.linear(opts, hi, 1, scope='final_lin')
         if nowozin_trick:
             # We are doing GAN between our model Qz and the true Pz.
@@ -536,20 +615,22 @@ class ImagePot(Pot):
         # Thus first moments should be 0
         p1 = tf.reduce_mean(input_, 0)
         center_inp = input_ - p1 # Broadcasting
+        # Higher powers are all built from the shared square
+        center_sq = center_inp * center_inp
         # Second centered and normalized moments should be 1
-        p2 = tf.sqrt(1e-5 + tf.reduce_mean(tf.square(center_inp), 0))
-        normed_inp = center_inp / p2
+        p2 = tf.sqrt(1e-5 + tf.reduce_mean(center_sq, 0))
         # Third central moment should be 0
         # p3 = tf.pow(1e-5 + tf.abs(tf.reduce_mean(tf.pow(center_inp, 3), 0)), 1.0 / 3.0)
-        p3 = tf.abs(tf.reduce_mean(tf.pow(center_inp, 3), 0))
+        p3 = tf.abs(tf.reduce_mean(center_sq * center_inp, 0))
         # 4th central moment of any uni-variate Gaussian = 3 * sigma^4
         # p4 = tf.pow(1e-5 + tf.reduce_mean(tf.pow(center_inp, 4), 0) / 3.0, 1.0 / 4.0)
-        p4 = tf.reduce_mean(tf.pow(center_inp, 4), 0) / 3.
+        p4 = tf.reduce_mean(center_sq * center_sq, 0) / 3.
         def zero_t(v):
             return tf.sqrt(1e-5 + tf.reduce_mean(tf.square(v)))
         def one_t(v):
             # The function below takes its minimum value 1. at v = 1.
-            return tf.sqrt(1e-5 + tf.reduce_mean(tf.maximum(tf.square(v), 1.0 / (1e-5 + tf.square(v)))))
+            sq = tf.square(v)
+            return tf.sqrt(1e-5 + tf.reduce_mean(tf.maximum(sq, tf.reciprocal(1e-5 + sq))))
         return tf.stack([zero_t(p1), one_t(p2), zero_t(p3), one_t(p4)])
 
     def discriminator_test(self, opts, input_):
@@ -572,11 +653,15 @@ class ImagePot(Pot):
         """
         add_dim = opts['z_test_proj_dim']
         if add_dim > 0:
-            dim = int(input_.get_shape()[1])
-            proj = np.random.rand(dim, add_dim)
-            proj = proj - np.mean(proj, 0)
-            norms = np.sqrt(np.sum(np.square(proj), 0) + 1e-5)
-            proj = tf.constant(proj / norms, dtype=tf.float32)
+            if self._cramer_proj is None:
+                # Same random projections for every call of the test.
+                dim = int(input_.get_shape()[1])
+                rng = np.random.RandomState(opts['random_seed'])
+                proj = rng.rand(dim, add_dim)
+                proj = proj - np.mean(proj, 0)
+                norms = np.sqrt(np.sum(np.square(proj), 0) + 1e-5)
+                self._cramer_proj = tf.constant(proj / norms, dtype=tf.float32)
+            proj = self._cramer_proj
             projected_x = tf.matmul(input_, proj)  # Shape [batch_size, add_dim].
 
             # Shape [batch_size, z_dim+add_dim]
@@ -587,15 +672,13 @@ class ImagePot(Pot):
         # top_k can only sort on the last dimension and we want to sort the
         # first one (batch_size).
         batch_size = self.get_batch_size(opts, all_dims_x)
+        expected = (2 * tf.range(1, batch_size+1, 1, dtype="float") - 1) / (2.0 * batch_size)
         transposed = tf.transpose(all_dims_x, perm=[1, 0])
-        values, indices = tf.nn.top_k(transposed, k=tf.cast(batch_size, tf.int32))
-        values = tf.reverse(values, [1])
+        # Ascending sort as a single top_k of the negated values.
+        values = -tf.nn.top_k(-transposed, k=tf.cast(batch_size, tf.int32))[0]
         #values = tf.Print(values, [values], "sorted values")
-        normal_dist = tf.contrib.distributions.Normal(0., float(opts['pot_pz_std']))
-        #
-        normal_cdf = normal_dist.cdf(values)
+        normal_cdf = gaussian_cdf(values, float(opts['pot_pz_std']))
         #normal_cdf = tf.Print(normal_cdf, [normal_cdf], "normal_cdf")
-        expected = (2 * tf.range(1, batch_size+1, 1, dtype="float") - 1) / (2.0 * batch_size)
         #expected = tf.Print(expected, [expected], "expected")
         # We don't use the constant.
         # constant = 1.0 / (12.0 * batch_size * batch_size)
@@ -620,16 +703,15 @@ class ImagePot(Pot):
         # top_k can only sort on the last dimension and we want to sort the
         # first one (batch_size).
         batch_size = self.get_batch_size(opts, input_)
+        w1 = 2 * tf.range(1, batch_size + 1, 1, dtype="float") - 1
+        w2 = 2 * tf.range(batch_size - 1, -1, -1, dtype="float") + 1
         transposed = tf.transpose(input_, perm=[1, 0])
-        values, indices = tf.nn.top_k(transposed, k=tf.cast(batch_size, tf.int32))
-        values = tf.reverse(values, [1])
-        normal_dist = tf.contrib.distributions.Normal(0., float(opts['pot_pz_std']))
-        normal_cdf = normal_dist.cdf(values)
+        # Ascending sort as a single top_k of the negated values.
+        values = -tf.nn.top_k(-transposed, k=tf.cast(batch_size, tf.int32))[0]
+        normal_cdf = gaussian_cdf(values, float(opts['pot_pz_std']))
         # ln_normal_cdf is of shape (z_dim, batch_size)
         ln_normal_cdf = tf.log(normal_cdf)
         ln_one_normal_cdf = tf.log(1.0 - normal_cdf)
-        w1 = 2 * tf.range(1, batch_size + 1, 1, dtype="float") - 1
-        w2 = 2 * tf.range(batch_size - 1, -1, -1, dtype="float") + 1
         stat = -batch_size - tf.reduce_sum(w1 * ln_normal_cdf + \
                                            w2 * ln_one_normal_cdf, 1) / batch_size
         # stat is of shape (z_dim)
@@ -655,7 +737,7 @@ class ImagePot(Pot):
         # input_ = opts['pot_pz_std'] * utils.generate_noise(opts, 100000)
         batch_size = self.get_batch_size(opts, input_)
         batch_size = tf.cast(batch_size, tf.int32)
-        half_size = batch_size / 2
+        half_size = batch_size // 2
         # s1 = tf.slice(input_, [0, 0], [half_size, -1])
         # s2 = tf.slice(input_, [half_size, 0], [half_size, -1])
         s1 = input_[:half_size, :]
@@ -700,7 +782,7 @@ class ImagePot(Pot):
         """
         n = self.get_batch_size(opts, input_)
         n = tf.cast(n, tf.int32)
-        half_size = (n * n - n) / 2
+        half_size = (n * n - n) // 2
         nf = tf.cast(n, tf.float32)
         norms = tf.reduce_sum(tf.square(input_), axis=1, keep_dims=True)
         dotprods = tf.matmul(input_, input_, transpose_b=True)
@@ -735,7 +817,7 @@ class ImagePot(Pot):
         n = self.get_batch_size(opts, sample_qz)
         n = tf.cast(n, tf.int32)
         nf = tf.cast(n, tf.float32)
-        half_size = (n * n - n) / 2
+        half_size = (n * n - n) // 2
         # Pz
         norms_pz = tf.reduce_sum(tf.square(sample_pz), axis=1, keep_dims=True)
         dotprods_pz = tf.matmul(sample_pz, sample_pz, transpose_b=True)
@@ -812,20 +894,21 @@ class ImagePot(Pot):
 
         batch_size = self.get_batch_size(opts, input_)
         dim = int(input_.get_shape()[1])
-        transposed = tf.transpose(input_, perm=[1, 0])
-        mean = tf.reshape(tf.reduce_mean(transposed, axis=1), [-1, 1])
-        centered_transposed = transposed - mean # Broadcasting mean
-        cov = tf.matmul(centered_transposed, centered_transposed, transpose_b=True)
+        mean = tf.reduce_mean(input_, axis=0, keep_dims=True)
+        centered = input_ - mean # Broadcasting mean
+        cov = tf.matmul(centered, centered, transpose_a=True)
         cov = cov / (batch_size - 1)
         #cov = tf.Print(cov, [cov], "cov")
         sigmas = tf.sqrt(tf.diag_part(cov) + 1e-5)
         #sigmas = tf.Print(sigmas, [sigmas], "sigmas")
-        sigmas = tf.reshape(sigmas, [1, -1])
-        sigmas = tf.matmul(sigmas, sigmas, transpose_a=True)
+        # Outer product of the standard deviations
+        sigmas = tf.expand_dims(sigmas, 1) * tf.expand_dims(sigmas, 0)
         #sigmas = tf.Print(sigmas, [sigmas], "sigmas")
         # Pearson's correlation
         corr = cov / sigmas
-        triangle = tf.matrix_set_diag(tf.matrix_band_part(corr, 0, -1), tf.zeros(dim))
+        # Strictly upper triangular part, selected with a constant mask
+        mask = np.triu(np.ones((dim, dim), dtype=np.float32), k=1)
+        triangle = corr * tf.constant(mask)
         #triangle = tf.Print(triangle, [triangle], "triangle")
         loss = tf.reduce_sum(tf.square(triangle)) / ((dim * dim - dim) / 2.0)
         #loss = tf.Print(loss, [loss], "Correlation loss")
@@ -833,10 +916,23 @@ class ImagePot(Pot):
 
 
     def encoder(self, opts, input_, is_training=False, reuse=False, keep_prob=1.):
+        """Encoder, run in half precision if opts['fp16'].
+
+        Outputs are always float32.
+        """
+        if not opts['fp16']:
+            return self._encoder_net(opts, input_, is_training, reuse, keep_prob)
+        res = self._encoder_net(
+            opts, tf.cast(input_, tf.float16), is_training, reuse, keep_prob)
+        if opts['e_is_random']:
+            return tf.cast(res[0], tf.float32), tf.cast(res[1], tf.float32)
+        return tf.cast(res, tf.float32)
+
+    def _encoder_net(self, opts, input_, is_training, reuse, keep_prob):
         if opts['e_add_noise']:
             def add_noise(x):
                 shape = tf.shape(x)
-                return x + tf.truncated_normal(shape, 0.0, 0.01)
+                return x + tf.truncated_normal(shape, 0.0, 0.01, dtype=x.dtype)
             def do_nothing(x):
                 return x
             input_ = tf.cond(is_training, lambda: add_noise(input_), lambda: do_nothing(input_))
@@ -846,10 +942,13 @@ class ImagePot(Pot):
             if not opts['convolutions']:
                 hi = input_
                 for i in range(num_layers):
-                    hi = ops.linear(opts, hi, num_units, scope='h%d_lin' % i)
                     if opts['batch_norm']:
+                        hi = ops.linear(opts, hi, num_units, scope='h%d_lin' % i)
                         hi = ops.batch_norm(opts, hi, is_training, reuse, scope='bn%d' % i)
-                    hi = tf.nn.relu(hi)
+                        hi = tf.nn.relu(hi)
+                    else:
+                        hi = ops.linear(opts, hi, num_units, scope='h%d_lin' % i,
+                                        activation=tf.nn.relu)
                 if opts['e_is_random']:
                     latent_mean = ops.linear(
                         opts, hi, opts['latent_space_dim'], 'h%d_lin' % (i + 1))
@@ -871,22 +970,22 @@ class ImagePot(Pot):
         num_units = opts['e_num_filters']
         num_layers = opts['e_num_layers']
         layer_x = input_
-        for i in xrange(num_layers):
+        for i in range(num_layers):
             scale = 2**(num_layers-i-1)
-            layer_x = ops.conv2d(opts, layer_x, num_units / scale, scope='h%d_conv' % i)
+            layer_x = ops.conv2d(opts, layer_x, num_units // scale, scope='h%d_conv' % i)
 
             if opts['batch_norm']:
-                layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bn%d' % i)
+                layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bn%d' % i, fused=True)
             layer_x = tf.nn.relu(layer_x)
             if opts['dropout']:
                 _keep_prob = tf.minimum(
                     1., 0.9 - (0.9 - keep_prob) * float(i + 1) / num_layers)
-                layer_x = tf.nn.dropout(layer_x, _keep_prob)
+                layer_x = tf.nn.dropout(layer_x, tf.cast(_keep_prob, layer_x.dtype))
 
             if opts['e_3x3_conv'] > 0:
                 before = layer_x
                 for j in range(opts['e_3x3_conv']):
-                    layer_x = ops.conv2d(opts, layer_x, num_units / scale, d_h=1, d_w=1,
+                    layer_x = ops.conv2d(opts, layer_x, num_units // scale, d_h=1, d_w=1,
                                          scope='conv2d_3x3_%d_%d' % (i, j),
                                          conv_filters_dim=3)
                     layer_x = tf.nn.relu(layer_x)
@@ -904,26 +1003,26 @@ class ImagePot(Pot):
     def ali_encoder(self, opts, input_, is_training=False, reuse=False, keep_prob=1.):
         num_units = opts['e_num_filters']
         layer_params = []
-        layer_params.append([5, 1, num_units / 8])
-        layer_params.append([4, 2, num_units / 4])
-        layer_params.append([4, 1, num_units / 2])
+        layer_params.append([5, 1, num_units // 8])
+        layer_params.append([4, 2, num_units // 4])
+        layer_params.append([4, 1, num_units // 2])
         layer_params.append([4, 2, num_units])
         layer_params.append([4, 1, num_units * 2])
-        # For convolution: (n - k) / stride + 1 = s
+        # For convolution: (n - k) // stride + 1 = s
         # For transposed: (s - 1) * stride + k = n
         layer_x = input_
         height = int(layer_x.get_shape()[1])
         width = int(layer_x.get_shape()[2])
         assert height == width
         for i, (kernel, stride, channels) in enumerate(layer_params):
-            height = (height - kernel) / stride + 1
+            height = (height - kernel) // stride + 1
             width = height
             # print((height, width))
             layer_x = ops.conv2d(
                 opts, layer_x, channels, d_h=stride, d_w=stride,
                 scope='h%d_conv' % i, conv_filters_dim=kernel, padding='VALID')
             if opts['batch_norm']:
-                layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bn%d' % i)
+                layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bn%d' % i, fused=True)
             layer_x = ops.lrelu(layer_x, 0.1)
         assert height == 1
         assert width == 1
@@ -931,9 +1030,9 @@ class ImagePot(Pot):
         # Then two 1x1 convolutions.
         layer_x = ops.conv2d(opts, layer_x, num_units * 2, d_h=1, d_w=1, scope='conv2d_1x1', conv_filters_dim=1)
         if opts['batch_norm']:
-            layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bnlast')
+            layer_x = ops.batch_norm(opts, layer_x, is_training, reuse, scope='bnlast', fused=True)
         layer_x = ops.lrelu(layer_x, 0.1)
-        layer_x = ops.conv2d(opts, layer_x, num_units / 2, d_h=1, d_w=1, scope='conv2d_1x1_2', conv_filters_dim=1)
+        layer_x = ops.conv2d(opts, layer_x, num_units // 2, d_h=1, d_w=1, scope='conv2d_1x1_2', conv_filters_dim=1)
 
         if opts['e_is_random']:
             latent_mean = ops.linear(
@@ -949,14 +1048,14 @@ class ImagePot(Pot):
         assert num_units == opts['g_num_filters'], 'BEGAN requires same number of filters in encoder and decoder'
         num_layers = opts['e_num_layers']
         layer_x = ops.conv2d(opts, input_, num_units, scope='h_first_conv')
-        for i in xrange(num_layers):
+        for i in range(num_layers):
             if i % 3 < 2:
                 if i != num_layers - 2:
-                    ii = i - (i / 3)
-                    scale = (ii + 1 - ii / 2)
+                    ii = i - (i // 3)
+                    scale = (ii + 1 - ii // 2)
                 else:
-                    ii = i - (i / 3)
-                    scale = (ii - (ii - 1) / 2)
+                    ii = i - (i // 3)
+                    scale = (ii - (ii - 1) // 2)
                 layer_x = ops.conv2d(opts, layer_x, num_units * scale, d_h=1, d_w=1, scope='h%d_conv' % i)
                 layer_x = tf.nn.elu(layer_x)
             else:
@@ -981,40 +1080,52 @@ class ImagePot(Pot):
         width = int(real_points.get_shape()[2])
         depth = int(real_points.get_shape()[3])
         # logging.error("real_points shape", real_points.get_shape())
-        def _distort_func(image):
+        def _augment_batch(images):
+            # All the distortions below act on the whole 4d batch at once,
+            # so no per-image While loop is built in the graph.
             # tf.image.per_image_standardization(image), should we?
-            # Pad with zeros.
-            image = tf.image.resize_image_with_crop_or_pad(
-                image, height+4, width+4)
-            image = tf.random_crop(image, [height, width, depth])
-            image = tf.image.random_flip_left_right(image)
-            image = tf.image.random_brightness(image, max_delta=0.1)
-            image = tf.minimum(tf.maximum(image, 0.0), 1.0)
-            image = tf.image.random_contrast(image, lower=0.8, upper=1.3)
-            image = tf.minimum(tf.maximum(image, 0.0), 1.0)
-            image = tf.image.random_hue(image, 0.08)
-            image = tf.minimum(tf.maximum(image, 0.0), 1.0)
-            image = tf.image.random_saturation(image, lower=0.8, upper=1.3)
-            image = tf.minimum(tf.maximum(image, 0.0), 1.0)
-            return image
-
-        def _regular_func(image):
-            # tf.image.per_image_standardization(image)?
-            return image
+            batch_size = tf.shape(images)[0]
+            # Pad with zeros and crop back, same offset for the batch.
+            images = tf.image.resize_image_with_crop_or_pad(
+                images, height+4, width+4)
+            images = tf.random_crop(
+                images, tf.stack([batch_size, height, width, depth]))
+            # The crop size is a tensor, restore the static shape for the
+            # variables of the encoder.
+            images.set_shape([None, height, width, depth])
+            # Flip every image with probability 1/2.
+            flip = tf.less(tf.random_uniform(tf.stack([batch_size])), 0.5)
+            images = tf.where(flip, tf.reverse(images, [2]), images)
+            # Brightness and contrast jitter, one factor per image.
+            jitter_shape = tf.stack([batch_size, 1, 1, 1])
+            images = images + tf.random_uniform(jitter_shape, -0.1, 0.1)
+            means = tf.reduce_mean(images, [1, 2], keep_dims=True)
+            contrast = tf.random_uniform(jitter_shape, 0.8, 1.3)
+            images = (images - means) * contrast + means
+            images = tf.image.adjust_hue(
+                images, tf.random_uniform([], -0.08, 0.08))
+            images = tf.image.adjust_saturation(
+                images, tf.random_uniform([], 0.8, 1.3))
+            # Clip back to valid range only once, after all the jitters.
+            images = tf.clip_by_value(images, 0.0, 1.0)
+            return images
 
         distorted_images = tf.cond(
             is_training,
-            lambda: tf.map_fn(_distort_func, real_points,
-                              parallel_iterations=100),
-            lambda: tf.map_fn(_regular_func, real_points,
-                              parallel_iterations=100))
+            lambda: _augment_batch(real_points),
+            lambda: real_points)
 
         return distorted_images
 
     def _recon_loss_using_disc_encoder(
             self, opts, reconstructed_training, encoded_training,
-            real_points, is_training_ph, keep_prob_ph):
-        """Build an additional loss using the encoder as discriminator."""
+            encoded_mean, is_training_ph, keep_prob_ph):
+        """Build an additional loss using the encoder as discriminator.
+
+        encoded_mean is the (deterministic part of the) encoder output on
+        the real points. Real points do not depend on any trainable
+        variables, so it can be used directly instead of re-encoding them.
+        """
         reconstructed_reencoded_sg = self.encoder(
             opts, tf.stop_gradient(reconstructed_training),
             is_training=is_training_ph, keep_prob=keep_prob_ph, reuse=True)
@@ -1028,14 +1139,9 @@ class ImagePot(Pot):
         # Below line enforces the forward to be reconstructed_reencoded and backwards to NOT change the encoder....
         crazy_hack = reconstructed_reencoded - reconstructed_reencoded_sg +\
             tf.stop_gradient(reconstructed_reencoded_sg)
-        encoded_training_sg = self.encoder(
-            opts, tf.stop_gradient(real_points),
-            is_training=is_training_ph, keep_prob=keep_prob_ph, reuse=True)
-        if opts['e_is_random']:
-            encoded_training_sg = encoded_training_sg[0]
 
         adv_fake_layer = ops.linear(opts, reconstructed_reencoded_sg, 1, scope='adv_layer')
-        adv_true_layer = ops.linear(opts, encoded_training_sg, 1, scope='adv_layer', reuse=True)
+        adv_true_layer = ops.linear(opts, encoded_mean, 1, scope='adv_layer', reuse=True)
         adv_fake = tf.nn.sigmoid_cross_entropy_with_logits(
                     logits=adv_fake_layer, labels=tf.zeros_like(adv_fake_layer))
         adv_true = tf.nn.sigmoid_cross_entropy_with_logits(
@@ -1088,7 +1194,7 @@ class ImagePot(Pot):
                 linear_outputs = []
                 for filter_size in filter_sizes:
                     layer_x = inputs
-                    for i in xrange(num_layers):
+                    for i in range(num_layers):
     #                     scale = 2**(num_layers-i-1)
                         layer_x = ops.conv2d(opts, layer_x, num_units, d_h=1, d_w=1, scope='h%d_conv%d' % (i, filter_size),
                                              conv_filters_dim=filter_size, padding='SAME')
@@ -1148,12 +1254,8 @@ class ImagePot(Pot):
     def _recon_loss_using_disc_conv_eb(self, opts, reconstructed_training, real_points, is_training, keep_prob):
         """Build an additional loss using a discriminator in X space, using Energy Based approach."""
         def copy3D(height, width, channels):
-            m = np.zeros([height, width, channels, height, width, channels])
-            for i in xrange(height):
-                for j in xrange(width):
-                    for c in xrange(channels):
-                        m[i, j, c, i, j, c] = 1.0
-            return tf.constant(np.reshape(m, [height, width, channels, -1]), dtype=tf.float32)
+            m = np.eye(height * width * channels, dtype=np.float32)
+            return tf.constant(np.reshape(m, [height, width, channels, -1]))
 
         def _architecture(inputs, reuse=None):
             dim = opts['adv_c_patches_size']
@@ -1164,7 +1266,7 @@ class ImagePot(Pot):
                 num_units = opts['adv_c_num_units']
                 num_layers = 1
                 layer_x = inputs
-                for i in xrange(num_layers):
+                for i in range(num_layers):
 #                     scale = 2**(num_layers-i-1)
                     layer_x = ops.conv2d(opts, layer_x, num_units, d_h=1, d_w=1, scope='h%d_conv' % i,
                                          conv_filters_dim=dim, padding='SAME')
@@ -1362,14 +1464,14 @@ class ImagePot(Pot):
             dot_prod = -1
             best_of_runs = 10e5 # Any positive value would do
             updated = False
-            for _start in xrange(3):
+            for _start in range(3):
                 # We will run 3 times from random inits
                 loss_prev = 10e5 # Any positive value would do
                 proj_vars = tf.get_collection(
                     tf.GraphKeys.GLOBAL_VARIABLES, scope="leastGaussian2d")
                 self._session.run(tf.variables_initializer(proj_vars))
                 step = 0
-                for _ in xrange(5000):
+                for _ in range(5000):
                     self._session.run(optim, feed_dict={sample_ph:X})
                     step += 1
                     if step % 10 == 0:
@@ -1388,6 +1490,25 @@ class ImagePot(Pot):
             logging.error('WARNING: possible bug in the worst 2d projection')
         return proj_mat, dot_prod
 
+    def _minimize_scaled(self, opts, optimizer, loss, var_list,
+                         global_step=None):
+        """optimizer.minimize with static loss scaling for half precision.
+
+        Gradients of the half precision nets are computed for the scaled
+        loss, so that small values do not underflow, and unscaled in float32
+        before they are applied.
+        """
+        if not opts['fp16']:
+            return optimizer.minimize(
+                loss=loss, var_list=var_list, global_step=global_step)
+        scale = float(opts['fp16_loss_scale'])
+        grads_and_vars = optimizer.compute_gradients(
+            loss * scale, var_list=var_list)
+        grads_and_vars = [(g / scale if g is not None else None, v)
+                          for g, v in grads_and_vars]
+        return optimizer.apply_gradients(
+            grads_and_vars, global_step=global_step)
+
     def _build_model_internal(self, opts):
         """Build the Graph corresponding to POT implementation.
 
@@ -1395,14 +1516,65 @@ class ImagePot(Pot):
         data_shape = self._data.data_shape
         additional_losses = collections.OrderedDict()
 
-        # Placeholders
-        real_points_ph = tf.placeholder(
-            tf.float32, [None] + list(data_shape), name='real_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
-        enc_noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='enc_noise_ph')
-        lr_decay_ph = tf.placeholder(tf.float32)
+        # Training minibatches come from a prefetching input pipeline,
+        # so that sampling the next batch overlaps with the current step.
+        z_shape = [None, opts['latent_space_dim']]
+        train_batches = tf.data.Dataset.from_generator(
+            lambda: self._sample_train_batches(opts),
+            tf.float32, [None] + list(data_shape))
+        train_batches = train_batches.prefetch(2)
+        train_iterator = train_batches.make_one_shot_iterator()
+        # Test points used for the reconstruction loss logged while
+        # training. Kept on the device, so that they are not fed every time.
+        # The variable is left out of all collections: it is initialized
+        # from a feed together with the other additional init ops and is
+        # not written into checkpoints.
+        use_test_ph = None
+        if self._data.test_data is not None:
+            test = self._data.test_data[:200]
+            test_init_ph = tf.placeholder(
+                tf.float32, test.shape, name='test_points_init_ph')
+            test_points = tf.Variable(
+                test_init_ph, trainable=False, collections=[],
+                name='test_points')
+            self._additional_init_ops.append(test_points.initializer)
+            self._init_feed_dict[test_init_ph] = test
+            use_test_ph = tf.placeholder_with_default(
+                False, [], name='use_test_ph')
+            batch_images = tf.cond(
+                use_test_ph, lambda: tf.identity(test_points),
+                train_iterator.get_next)
+        else:
+            batch_images = train_iterator.get_next()
+
+        # Placeholders. Data defaults to the next training minibatch (or
+        # the test points) and both noises are sampled in the graph for as
+        # many points as there are in real_points_ph. They are fed
+        # explicitly only for evaluation and plots.
+        real_points_ph = tf.placeholder_with_default(
+            batch_images, [None] + list(data_shape), name='real_points_ph')
+        num_points = tf.shape(real_points_ph)[0]
+        noise_ph = tf.placeholder_with_default(
+            opts['pot_pz_std'] * random_noise(opts, num_points),
+            z_shape, name='noise_ph')
+        enc_noise_ph = tf.placeholder_with_default(
+            random_noise(opts, num_points), z_shape, name='enc_noise_ph')
+        # Learning rate decay. Schedules depending only on the epoch are
+        # computed in the graph from the number of encoder-decoder updates.
+        # The plateau schedule depends on the losses and is fed from Python.
+        global_step = tf.train.get_or_create_global_step()
+        epoch = global_step // (self._data.num_points // opts['batch_size'])
+        if opts['decay_schedule'] == "plateau":
+            lr_decay = tf.constant(1.)
+        elif opts['decay_schedule'] == "manual":
+            lr_decay = tf.train.piecewise_constant(
+                epoch, [29, 49, 99], [1., 0.5, 0.1, 0.01])
+        else:
+            assert type(1.0 * opts['decay_schedule']) == float
+            lr_decay = tf.pow(10., -tf.cast(epoch, tf.float32) /
+                              float(opts['decay_schedule']))
+        lr_decay_ph = tf.placeholder_with_default(
+            lr_decay, [], name='lr_decay_ph')
         is_training_ph = tf.placeholder(tf.bool, name='is_training_ph')
         keep_prob_ph = tf.placeholder(tf.float32, name='keep_prob_ph')
 
@@ -1416,109 +1588,116 @@ class ImagePot(Pot):
         real_points = self._data_augmentation(
             opts, real_points_ph, is_training_ph)
 
-        if opts['e_is_random']:
-            # If encoder is random we map the training points
-            # to the expectation of Q(Z|X) and then add the scaled
-            # Gaussian noise corresponding to the learned sigmas
-            enc_train_mean, enc_log_sigmas = self.encoder(
-                opts, real_points,
-                is_training=is_training_ph, keep_prob=keep_prob_ph)
-            # enc_log_sigmas = tf.Print(enc_log_sigmas, [tf.reduce_max(enc_log_sigmas),
-            #                                            tf.reduce_min(enc_log_sigmas),
-            #                                            tf.reduce_mean(enc_log_sigmas)], 'Log sigmas:')
-            # enc_log_sigmas = tf.Print(enc_log_sigmas, [tf.slice(enc_log_sigmas, [0,0], [1,-1])], 'Log sigmas:')
-            # stds = tf.sqrt(tf.exp(enc_log_sigmas) + 1e-05)
-            stds = tf.sqrt(tf.nn.relu(enc_log_sigmas) + 1e-05)
-            # stds = tf.Print(stds, [stds[0], stds[1], stds[2], stds[3]], 'Stds: ')
-            # stds = tf.Print(stds, [enc_train_mean[0], enc_train_mean[1], enc_train_mean[2]], 'Means: ')
-            scaled_noise = tf.multiply(stds, enc_noise_ph)
-            encoded_training = enc_train_mean + scaled_noise
-        else:
-            encoded_training = self.encoder(
-                opts, real_points,
+        # Forward pass and the main losses are marked for XLA compilation,
+        # which fuses the long chains of small elementwise ops.
+        with jit.experimental_jit_scope(compile_ops=opts['xla_jit']):
+            if opts['e_is_random']:
+                # If encoder is random we map the training points
+                # to the expectation of Q(Z|X) and then add the scaled
+                # Gaussian noise corresponding to the learned sigmas
+                enc_train_mean, enc_log_sigmas = self.encoder(
+                    opts, real_points,
+                    is_training=is_training_ph, keep_prob=keep_prob_ph)
+                # enc_log_sigmas = tf.Print(enc_log_sigmas, [tf.reduce_max(enc_log_sigmas),
+                #                                            tf.reduce_min(enc_log_sigmas),
+                #                                            tf.reduce_mean(enc_log_sigmas)], 'Log sigmas:')
+                # enc_log_sigmas = tf.Print(enc_log_sigmas, [tf.slice(enc_log_sigmas, [0,0], [1,-1])], 'Log sigmas:')
+                # stds = tf.sqrt(tf.exp(enc_log_sigmas) + 1e-05)
+                stds = tf.sqrt(tf.nn.relu(enc_log_sigmas) + 1e-05)
+                # stds = tf.Print(stds, [stds[0], stds[1], stds[2], stds[3]], 'Stds: ')
+                # stds = tf.Print(stds, [enc_train_mean[0], enc_train_mean[1], enc_train_mean[2]], 'Means: ')
+                scaled_noise = tf.multiply(stds, enc_noise_ph)
+                encoded_training = enc_train_mean + scaled_noise
+            else:
+                encoded_training = self.encoder(
+                    opts, real_points,
+                    is_training=is_training_ph, keep_prob=keep_prob_ph)
+            reconstructed_training = self.generator(
+                opts, encoded_training,
                 is_training=is_training_ph, keep_prob=keep_prob_ph)
-        reconstructed_training = self.generator(
-            opts, encoded_training,
-            is_training=is_training_ph, keep_prob=keep_prob_ph)
-        reconstructed_training.set_shape(real_points.get_shape())
-
-        if opts['recon_loss'] == 'l2':
-            # c(x,y) = ||x - y||_2
-            loss_reconstr = tf.reduce_sum(
-                tf.square(real_points - reconstructed_training), axis=1)
-            # sqrt(x + delta) guarantees the direvative 1/(x + delta) is finite
-            loss_reconstr = tf.reduce_mean(tf.sqrt(loss_reconstr + 1e-08))
-        elif opts['recon_loss'] == 'l2f':
-            # c(x,y) = ||x - y||_2
-            loss_reconstr = tf.reduce_sum(
-                tf.square(real_points - reconstructed_training), axis=[1, 2, 3])
-            loss_reconstr = tf.reduce_mean(tf.sqrt(1e-08 + loss_reconstr)) * 0.2
-        elif opts['recon_loss'] == 'l2sq':
-            # c(x,y) = ||x - y||_2^2
-            loss_reconstr = tf.reduce_sum(
-                tf.square(real_points - reconstructed_training), axis=[1, 2, 3])
-            loss_reconstr = tf.reduce_mean(loss_reconstr) * 0.05
-        elif opts['recon_loss'] == 'l1':
-            # c(x,y) = ||x - y||_1
-            loss_reconstr = tf.reduce_mean(tf.reduce_sum(
-                tf.abs(real_points - reconstructed_training), axis=[1, 2, 3])) * 0.02
-        else:
-            assert False
-
-        # Pearson independence test of coordinates in Z space
-        loss_z_corr = self.correlation_loss(opts, encoded_training)
-        # Perform a Qz = Pz goodness of fit test based on Stein Discrepancy
-        if opts['z_test'] == 'gan':
-            # Pz = Qz test based on GAN in the Z space
-            d_logits_Pz = self.discriminator(opts, noise)
-            d_logits_Qz = self.discriminator(opts, encoded_training, reuse=True)
-            d_loss_Pz = tf.reduce_mean(
-                tf.nn.sigmoid_cross_entropy_with_logits(
-                    logits=d_logits_Pz, labels=tf.ones_like(d_logits_Pz)))
-            d_loss_Qz = tf.reduce_mean(
-                tf.nn.sigmoid_cross_entropy_with_logits(
-                    logits=d_logits_Qz, labels=tf.zeros_like(d_logits_Qz)))
-            d_loss_Qz_trick = tf.reduce_mean(
-                tf.nn.sigmoid_cross_entropy_with_logits(
-                    logits=d_logits_Qz, labels=tf.ones_like(d_logits_Qz)))
-            d_loss = opts['pot_lambda'] * (d_loss_Pz + d_loss_Qz)
-            if opts['pz_transform']:
-                loss_match = d_loss_Qz_trick - d_loss_Pz
+            reconstructed_training.set_shape(real_points.get_shape())
+
+            # Per point difference as one flat vector, so that every
+            # cost reduces over all pixels in a single contiguous sweep.
+            recon_diff = flatten(real_points - reconstructed_training)
+            if opts['recon_loss'] == 'l2':
+                # c(x,y) = ||x - y||_2
+                loss_reconstr = tf.reduce_sum(tf.square(recon_diff), axis=1)
+                # sqrt(x + delta) guarantees the direvative 1/(x + delta) is finite
+                loss_reconstr = tf.reduce_mean(tf.sqrt(loss_reconstr + 1e-08))
+            elif opts['recon_loss'] == 'l2f':
+                # c(x,y) = ||x - y||_2
+                loss_reconstr = tf.reduce_sum(tf.square(recon_diff), axis=1)
+                loss_reconstr = tf.reduce_mean(tf.sqrt(1e-08 + loss_reconstr)) * 0.2
+            elif opts['recon_loss'] == 'l2sq':
+                # c(x,y) = ||x - y||_2^2
+                loss_reconstr = tf.reduce_sum(tf.square(recon_diff), axis=1)
+                loss_reconstr = tf.reduce_mean(loss_reconstr) * 0.05
+            elif opts['recon_loss'] == 'l1':
+                # c(x,y) = ||x - y||_1
+                loss_reconstr = tf.reduce_mean(tf.reduce_sum(
+                    tf.abs(recon_diff), axis=1)) * 0.02
             else:
-                loss_match = d_loss_Qz_trick
-        elif opts['z_test'] == 'mmd':
-            # Pz = Qz test based on MMD(Pz, Qz)
-            loss_match = self.discriminator_mmd_test(opts, encoded_training, noise)
-            d_loss = None
-            d_logits_Pz = None
-            d_logits_Qz = None
-        elif opts['z_test'] == 'lks':
-            # Pz = Qz test without adversarial training
-            # based on Kernel Stein Discrepancy
-            # Uncomment next line to check for the real Pz
-            # loss_match = self.discriminator_test(opts, noise_ph)
-            loss_match = self.discriminator_test(opts, encoded_training)
-            d_loss = None
-            d_logits_Pz = None
-            d_logits_Qz = None
-        else:
-            # Pz = Qz test without adversarial training
-            # (a) Check for multivariate Gaussianity
-            #     by checking Gaussianity of all the 1d projections
-            # (b) Run Pearson's test of coordinate independance
-            loss_match = self.discriminator_test(opts, encoded_training)
-            loss_match = loss_match + opts['z_test_corr_w'] * loss_z_corr
-            d_loss = None
-            d_logits_Pz = None
-            d_logits_Qz = None
-        g_mom_stats = self.moments_stats(opts, encoded_training)
-        loss = opts['reconstr_w'] * loss_reconstr + opts['pot_lambda'] * loss_match
+                assert False
+
+            # Pearson independence test of coordinates in Z space
+            loss_z_corr = self.correlation_loss(opts, encoded_training)
+            # Perform a Qz = Pz goodness of fit test based on Stein Discrepancy
+            if opts['z_test'] == 'gan':
+                # Pz = Qz test based on GAN in the Z space. A single
+                # discriminator pass on Qz serves both d_loss and loss_match,
+                # the variable lists of the two optimizers only select which
+                # part of its backward pass gets computed.
+                d_logits_Pz = self.discriminator(opts, noise)
+                d_logits_Qz = self.discriminator(opts, encoded_training, reuse=True)
+                d_loss_Pz = tf.reduce_mean(
+                    tf.nn.sigmoid_cross_entropy_with_logits(
+                        logits=d_logits_Pz, labels=tf.ones_like(d_logits_Pz)))
+                d_loss_Qz = tf.reduce_mean(
+                    tf.nn.sigmoid_cross_entropy_with_logits(
+                        logits=d_logits_Qz, labels=tf.zeros_like(d_logits_Qz)))
+                # -log(sigmoid(x)) = -log(1 - sigmoid(x)) - x, so the
+                # non-saturating loss reuses the cross entropy above
+                d_loss_Qz_trick = d_loss_Qz - tf.reduce_mean(d_logits_Qz)
+                d_loss = opts['pot_lambda'] * (d_loss_Pz + d_loss_Qz)
+                if opts['pz_transform']:
+                    loss_match = d_loss_Qz_trick - d_loss_Pz
+                else:
+                    loss_match = d_loss_Qz_trick
+            elif opts['z_test'] == 'mmd':
+                # Pz = Qz test based on MMD(Pz, Qz)
+                loss_match = self.discriminator_mmd_test(opts, encoded_training, noise)
+                d_loss = None
+                d_logits_Pz = None
+                d_logits_Qz = None
+            elif opts['z_test'] == 'lks':
+                # Pz = Qz test without adversarial training
+                # based on Kernel Stein Discrepancy
+                # Uncomment next line to check for the real Pz
+                # loss_match = self.discriminator_test(opts, noise_ph)
+                loss_match = self.discriminator_test(opts, encoded_training)
+                d_loss = None
+                d_logits_Pz = None
+                d_logits_Qz = None
+            else:
+                # Pz = Qz test without adversarial training
+                # (a) Check for multivariate Gaussianity
+                #     by checking Gaussianity of all the 1d projections
+                # (b) Run Pearson's test of coordinate independance
+                loss_match = self.discriminator_test(opts, encoded_training)
+                loss_match = loss_match + opts['z_test_corr_w'] * loss_z_corr
+                d_loss = None
+                d_logits_Pz = None
+                d_logits_Qz = None
+            g_mom_stats = self.moments_stats(opts, encoded_training)
+            loss = opts['reconstr_w'] * loss_reconstr + opts['pot_lambda'] * loss_match
 
         # Optionally, add one more cost function based on the embeddings
         # add a discriminator in the X space, reusing the encoder or a new model.
         if opts['adv_c_loss'] == 'encoder':
+            encoded_mean = enc_train_mean if opts['e_is_random'] else encoded_training
             adv_c_loss, emb_c_loss = self._recon_loss_using_disc_encoder(
-                opts, reconstructed_training, encoded_training, real_points, is_training_ph, keep_prob_ph)
+                opts, reconstructed_training, encoded_training, encoded_mean, is_training_ph, keep_prob_ph)
             loss += opts['adv_c_loss_w'] * adv_c_loss + opts['emb_c_loss_w'] * emb_c_loss
             additional_losses['adv_c'], additional_losses['emb_c'] = adv_c_loss, emb_c_loss
         elif opts['adv_c_loss'] == 'conv':
@@ -1571,35 +1750,61 @@ class ImagePot(Pot):
 
         # Optimizer ops
         t_vars = tf.trainable_variables()
+        trainable = tf.GraphKeys.TRAINABLE_VARIABLES
         # Updates for discriminator
-        d_vars = [var for var in t_vars if 'DISCRIMINATOR/' in var.name]
-        # Updates for everything but adversary (encoder, decoder and possibly pz-transform)
-        all_vars = [var for var in t_vars if 'DISCRIMINATOR/' not in var.name]
+        d_vars = tf.get_collection(trainable, scope='DISCRIMINATOR/')
         # Updates for everything but adversary (encoder, decoder and possibly pz-transform)
-        eg_vars = [var for var in t_vars if 'GENERATOR/' in var.name or 'ENCODER/' in var.name]
+        d_vars_set = set(d_vars)
+        all_vars = [var for var in t_vars if var not in d_vars_set]
         # Encoder variables separately if we want to pretrain
-        e_vars = [var for var in t_vars if 'ENCODER/' in var.name]
+        e_vars = tf.get_collection(trainable, scope='ENCODER/')
+        # Encoder and decoder variables
+        eg_vars = tf.get_collection(trainable, scope='GENERATOR/') + e_vars
 
         logging.error('Param num in G and E: %d' % \
                 np.sum([np.prod([int(d) for d in v.get_shape()]) for v in eg_vars]))
         for v in eg_vars:
             print v.name, [int(d) for d in v.get_shape()]
 
+        optim = self._minimize_scaled(
+            opts, ops.optimizer(opts, net='g', decay=lr_decay_ph), loss, all_vars,
+            global_step=global_step)
         if len(d_vars) > 0:
-            d_optim = ops.optimizer(opts, net='d', decay=lr_decay_ph).minimize(loss=d_loss, var_list=d_vars)
+            d_optimizer = ops.optimizer(opts, net='d', decay=lr_decay_ph)
+            d_optim = d_optimizer.minimize(loss=d_loss, var_list=d_vars)
+            # Discriminator update which runs in the same step right after
+            # the encoder-decoder update. It reuses the forward pass of that
+            # update (computed with the pre-update encoder) and shares the
+            # slots of d_optimizer with d_optim.
+            with tf.control_dependencies([optim]):
+                joint_d_optim = d_optimizer.minimize(
+                    loss=d_loss, var_list=d_vars)
+            joint_optim = tf.group(optim, joint_d_optim)
         else:
             d_optim = None
-        optim = ops.optimizer(opts, net='g', decay=lr_decay_ph).minimize(loss=loss, var_list=all_vars)
+            joint_optim = None
         pretrain_optim = None
         if opts['e_pretrain']:
-            pretrain_optim = ops.optimizer(opts, net='g').minimize(loss=loss_pretrain, var_list=e_vars)
+            pretrain_optim = self._minimize_scaled(
+                opts, ops.optimizer(opts, net='g'), loss_pretrain, e_vars)
 
 
         generated_images = self.generator(
             opts, noise, is_training=is_training_ph,
             reuse=True, keep_prob=keep_prob_ph)
+        # Same for the fixed noise used for plots. A separate generator
+        # call, since any use of noise_ph would evaluate its default and
+        # thereby pull a minibatch from the input pipeline.
+        if opts['pz_transform']:
+            plot_noise = self.pz_sampler(opts, self._noise_for_plots, reuse=True)
+        else:
+            plot_noise = self._noise_for_plots
+        plot_generated_images = self.generator(
+            opts, plot_noise, is_training=is_training_ph,
+            reuse=True, keep_prob=keep_prob_ph)
 
         self._real_points_ph = real_points_ph
+        self._use_test_ph = use_test_ph
         self._real_points = real_points
         self._noise_ph = noise_ph
         self._noise = noise
@@ -1619,19 +1824,25 @@ class ImagePot(Pot):
         self._g_mom_stats = g_mom_stats
         self._d_loss = d_loss
         self._generated = generated_images
+        self._plot_noise = plot_noise
+        self._plot_generated = plot_generated_images
         self._Qz = encoded_training
         self._reconstruct_x = reconstructed_training
 
         saver = tf.train.Saver(max_to_keep=10)
-        tf.add_to_collection('real_points_ph', self._real_points_ph)
-        tf.add_to_collection('noise_ph', self._noise_ph)
-        tf.add_to_collection('enc_noise_ph', self._enc_noise_ph)
+        # Tensors needed to use the saved model
+        saved_tensors = collections.OrderedDict([
+            ('real_points_ph', self._real_points_ph),
+            ('noise_ph', self._noise_ph),
+            ('enc_noise_ph', self._enc_noise_ph),
+            ('is_training_ph', self._is_training_ph),
+            ('keep_prob_ph', self._keep_prob_ph),
+            ('encoder', self._Qz),
+            ('decoder', self._generated)])
         if opts['pz_transform']:
-            tf.add_to_collection('noise', self._noise)
-        tf.add_to_collection('is_training_ph', self._is_training_ph)
-        tf.add_to_collection('keep_prob_ph', self._keep_prob_ph)
-        tf.add_to_collection('encoder', self._Qz)
-        tf.add_to_collection('decoder', self._generated)
+            saved_tensors['noise'] = self._noise
+        for name, tensor in saved_tensors.items():
+            tf.add_to_collection(name, tensor)
         if d_logits_Pz is not None:
             tf.add_to_collection('disc_logits_Pz', d_logits_Pz)
         if d_logits_Qz is not None:
@@ -1639,18 +1850,75 @@ class ImagePot(Pot):
 
         self._saver = saver
 
+        # Pre-bound callables for the main training step, which skip
+        # building and parsing the feed dict on every step. The minibatch
+        # is taken from the input pipeline. Each device to host copy is
+        # optional: callables are keyed by (fetch losses, fetch minibatch)
+        # and return [update op] + losses + [minibatch] accordingly.
+        train_feeds = [is_training_ph, keep_prob_ph]
+        if opts['decay_schedule'] == "plateau":
+            train_feeds = [lr_decay_ph] + train_feeds
+        def _make_train_steps(update):
+            steps = {}
+            for with_losses in (False, True):
+                for with_batch in (False, True):
+                    fetches = [update]
+                    if with_losses:
+                        fetches += [loss, loss_reconstr, loss_match]
+                    if with_batch:
+                        fetches.append(real_points_ph)
+                    steps[(with_losses, with_batch)] = \
+                        self._session.make_callable(
+                            fetches, feed_list=train_feeds)
+            return steps
+        self._train_steps = _make_train_steps(optim)
+        # Same, but also doing one discriminator update on the same batch
+        self._joint_train_steps = None
+        self._d_train_step = None
+        if joint_optim is not None:
+            self._joint_train_steps = _make_train_steps(joint_optim)
+            # Standalone discriminator update on an explicitly fed batch
+            self._d_train_step = self._session.make_callable(
+                [d_optim, d_loss],
+                feed_list=[real_points_ph] + train_feeds)
+
         logging.error("Building Graph Done.")
 
+    def _sample_ids(self, num):
+        """Sample num training point ids according to the data weights.
+
+        Sampling is with replacement and takes O(num) time per call.
+        """
+        train_size = self._data.num_points
+        ids = np.random.randint(0, train_size, num)
+        if self._alias_table is not None:
+            prob, alias = self._alias_table
+            ids = np.where(np.random.rand(num) < prob[ids], ids, alias[ids])
+        return ids
+
+    def _sample_train_batches(self, opts):
+        """Endless generator of training minibatches.
+
+        Points are sampled according to the data weights.
+        """
+        data = self._data.data
+        sample_ids = self._sample_ids
+        batch_size = opts['batch_size']
+        while True:
+            # A fresh array every time, as the input pipeline holds on
+            # to several batches at once
+            yield data.take(sample_ids(batch_size))
+
     def pretrain(self, opts):
         steps_max = 200
         batch_size = opts['e_pretrain_bsize']
-        for step in xrange(steps_max):
+        for step in range(steps_max):
             train_size = self._data.num_points
             data_ids = np.random.choice(train_size, min(train_size, batch_size),
                                         replace=False)
-            batch_images = self._data.data[data_ids].astype(np.float)
-            batch_noise = opts['pot_pz_std'] *\
-                utils.generate_noise(opts, batch_size)
+            batch_images = self._data.data[data_ids]
+            batch_noise = utils.generate_noise(
+                opts, batch_size, scale=opts['pot_pz_std'])
             # Noise for the random encoder (if present)
             batch_enc_noise = utils.generate_noise(opts, batch_size)
 
@@ -1676,21 +1944,55 @@ class ImagePot(Pot):
         """
         logging.error(opts)
 
-        batches_num = self._data.num_points / opts['batch_size']
-        train_size = self._data.num_points
-        num_plot = 320
-        sample_prev = np.zeros([num_plot] + list(self._data.data_shape))
+        batches_num = self._data.num_points // opts['batch_size']
+        num_plot = int(self._noise_for_plots.get_shape()[0])
+        sample_prev = np.zeros([num_plot] + list(self._data.data_shape),
+                               dtype=np.float32)
         l2s = []
         losses = []
         losses_rec = []
         losses_match = []
+        # Step numbers of the recorded losses
+        losses_steps = []
         wait = 0
 
         start_time = time.time()
         counter = 0
+        # Only the plateau schedule feeds the learning rate decay
         decay = 1.
+        step_feed = [True, opts['dropout_keep_prob']]
+        if opts['decay_schedule'] == "plateau":
+            step_feed = [decay] + step_feed
         logging.error('Training POT')
 
+        fuse_d_step = self._joint_train_steps is not None and \
+            opts['d_steps'] > 0 and not opts['d_new_minibatch']
+        if fuse_d_step:
+            train_steps = self._joint_train_steps
+            d_steps_done = 1
+        else:
+            train_steps = self._train_steps
+            d_steps_done = 0
+        # Plateau decay and verbose logging need the losses of every step
+        plateau = opts['decay_schedule'] == "plateau"
+        verbose = opts['verbose']
+        loss_every = opts['loss_every']
+        if plateau or verbose >= 2:
+            loss_every = 1
+        # Remaining discriminator updates, done outside of train_step
+        d_train_step = self._d_train_step
+        d_extra_steps = []
+        if self._d_optim is not None:
+            d_extra_steps = range(d_steps_done, opts['d_steps'])
+        d_new_minibatch = opts['d_new_minibatch']
+        data = self._data.data
+        batch_size = opts['batch_size']
+        plot_every = opts['plot_every']
+        # The minibatch is copied back from the device only when the extra
+        # D steps or the plots use it
+        d_needs_batch = len(d_extra_steps) > 0 and not d_new_minibatch
+        batch_images = None
+
         # Optionally we first pretrain the Qz to match mean and
         # covariance of Pz
         if opts['e_pretrain']:
@@ -1698,104 +2000,70 @@ class ImagePot(Pot):
             self.pretrain(opts)
             logging.error('Pretraining the encoder done')
 
-        for _epoch in xrange(opts["gan_epoch_num"]):
-
-            if opts['decay_schedule'] == "manual":
-                if _epoch == 30:
-                    decay = decay / 2.
-                if _epoch == 50:
-                    decay = decay / 5.
-                if _epoch == 100:
-                    decay = decay / 10.
-            elif opts['decay_schedule'] != "plateau":
-                assert type(1.0 * opts['decay_schedule']) == float
-                decay = 1.0 * 10**(-_epoch / float(opts['decay_schedule']))
+        for _epoch in range(opts["gan_epoch_num"]):
 
             if _epoch > 0 and _epoch % opts['save_every_epoch'] == 0:
-                os.path.join(opts['work_dir'], opts['ckpt_dir'])
                 self._saver.save(self._session,
                                  os.path.join(opts['work_dir'],
                                               opts['ckpt_dir'],
                                               'trained-pot'),
                                  global_step=counter)
 
-            for _idx in xrange(batches_num):
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
-                batch_images = self._data.data[data_ids].astype(np.float)
-                # Noise for the Pz=Qz GAN
-                batch_noise = opts['pot_pz_std'] *\
-                    utils.generate_noise(opts, opts['batch_size'])
-                # Noise for the random encoder (if present)
-                batch_enc_noise = utils.generate_noise(opts, opts['batch_size'])
-
-                # Update generator (decoder) and encoder
-                [_, loss, loss_rec, loss_match] = self._session.run(
-                    [self._optim,
-                     self._loss,
-                     self._loss_reconstruct,
-                     self._loss_match],
-                    feed_dict={self._real_points_ph: batch_images,
-                               self._noise_ph: batch_noise,
-                               self._enc_noise_ph: batch_enc_noise,
-                               self._lr_decay_ph: decay,
-                               self._is_training_ph: True,
-                               self._keep_prob_ph: opts['dropout_keep_prob']})
-
-                if opts['decay_schedule'] == "plateau":
-                    # First 30 epochs do nothing
-                    if _epoch >= 30:
-                        # If no significant progress was made in last 10 epochs
-                        # then decrease the learning rate.
-                        if loss < min(losses[-20 * batches_num:]):
-                            wait = 0
-                        else:
-                            wait += 1
-                        if wait > 10 * batches_num:
-                            decay = max(decay  / 1.4, 1e-6)
-                            logging.error('Reduction in learning rate: %f' % decay)
-                            wait = 0
-                losses.append(loss)
-                losses_rec.append(loss_rec)
-                losses_match.append(loss_match)
-                if opts['verbose'] >= 2:
-                    # logging.error('loss after %d steps : %f' % (counter, losses[-1]))
-                    logging.error('loss match  after %d steps : %f' % (counter, losses_match[-1]))
-
-                # Update discriminator in Z space (if any).
-                if self._d_optim is not None:
-                    for _st in range(opts['d_steps']):
-                        if opts['d_new_minibatch']:
-                            d_data_ids = np.random.choice(
-                                train_size, opts['batch_size'],
-                                replace=False, p=self._data_weights)
-                            d_batch_images = self._data.data[data_ids].astype(np.float)
-                            d_batch_enc_noise = utils.generate_noise(opts, opts['batch_size'])
-                        else:
-                            d_batch_images = batch_images
-                            d_batch_enc_noise = batch_enc_noise
-                        _ = self._session.run(
-                            [self._d_optim, self._d_loss],
-                            feed_dict={self._real_points_ph: d_batch_images,
-                                       self._noise_ph: batch_noise,
-                                       self._enc_noise_ph: d_batch_enc_noise,
-                                       self._lr_decay_ph: decay,
-                                       self._is_training_ph: True,
-                                       self._keep_prob_ph: opts['dropout_keep_prob']})
+            for _idx in range(batches_num):
+                # Update generator (decoder) and encoder, together with the
+                # first discriminator update when it uses the same minibatch
+                fetch_losses = counter % loss_every == 0
+                fetch_batch = d_needs_batch or \
+                    (verbose and (counter + 1) % plot_every == 0)
+                res = train_steps[(fetch_losses, fetch_batch)](*step_feed)
+                if fetch_batch:
+                    batch_images = res[-1]
+                if fetch_losses:
+                    [loss, loss_rec, loss_match] = res[1:4]
+                    if plateau:
+                        # First 30 epochs do nothing
+                        if _epoch >= 30:
+                            # If no significant progress was made in last 10 epochs
+                            # then decrease the learning rate.
+                            if loss < min(losses[-20 * batches_num:]):
+                                wait = 0
+                            else:
+                                wait += 1
+                            if wait > 10 * batches_num:
+                                decay = max(decay  / 1.4, 1e-6)
+                                step_feed[0] = decay
+                                logging.error('Reduction in learning rate: %f' % decay)
+                                wait = 0
+                    losses.append(loss)
+                    losses_rec.append(loss_rec)
+                    losses_match.append(loss_match)
+                    losses_steps.append(counter + 1)
+                    if verbose >= 2:
+                        # logging.error('loss after %d steps : %f' % (counter, losses[-1]))
+                        logging.error('loss match  after %d steps : %f' % (counter, losses_match[-1]))
+
+                # Remaining updates of discriminator in Z space (if any).
+                # The noise is sampled in the graph for every update.
+                for _st in d_extra_steps:
+                    if d_new_minibatch:
+                        d_batch_images = data.take(
+                            self._sample_ids(batch_size), out=self._batch_buf)
+                    else:
+                        d_batch_images = batch_images
+                    _ = d_train_step(d_batch_images, *step_feed)
                 counter += 1
                 now = time.time()
 
                 rec_test = None
-                if opts['verbose'] and counter % 500 == 0:
+                if verbose and counter % 500 == 0 and \
+                        self._use_test_ph is not None:
                     # Printing (training and test) loss values
-                    test = self._data.test_data[:200]
+                    # Test points are taken from the graph, see use_test_ph
                     [loss_rec_test, rec_test, g_mom_stats, loss_z_corr, additional_losses] = self._session.run(
                         [self._loss_reconstruct, self._reconstruct_x, self._g_mom_stats, self._loss_z_corr,
                          self._additional_losses],
-                        feed_dict={self._real_points_ph: test,
-                                   self._enc_noise_ph: utils.generate_noise(opts, len(test)),
+                        feed_dict={self._use_test_ph: True,
                                    self._is_training_ph: False,
-                                   self._noise_ph: batch_noise,
                                    self._keep_prob_ph: 1e5})
                     debug_str = 'Epoch: %d/%d, batch:%d/%d, batch/sec:%.2f' % (
                         _epoch+1, opts['gan_epoch_num'], _idx+1,
@@ -1805,35 +2073,29 @@ class ImagePot(Pot):
                     debug_str += ',' + ', '.join(
                         ['%s=%.2g' % (k, v) for (k, v) in additional_losses.items()])
                     logging.error(debug_str)
-                    if opts['verbose'] >= 2:
+                    if verbose >= 2:
                         logging.error(g_mom_stats)
                         logging.error(loss_z_corr)
-                    if counter % opts['plot_every'] == 0:
+                    if counter % plot_every == 0:
                         # plotting the test images.
-                        metrics = Metrics()
-                        merged = np.vstack([rec_test[:8 * 10], test[:8 * 10]])
-                        r_ptr = 0
-                        w_ptr = 0
-                        for _ in range(8 * 10):
-                            merged[w_ptr] = test[r_ptr]
-                            merged[w_ptr + 1] = rec_test[r_ptr]
-                            r_ptr += 1
-                            w_ptr += 2
-                        metrics.make_plots(
+                        test = self._data.test_data[:8 * 10]
+                        merged = self._merged_buf
+                        merged[0::2] = test
+                        merged[1::2] = rec_test[:8 * 10]
+                        self._test_metrics.make_plots(
                             opts,
                             counter,
                             None,
                             merged,
                             prefix='test_reconstr_e%04d_mb%05d_' % (_epoch, _idx))
 
-                if opts['verbose'] and counter % opts['plot_every'] == 0:
+                if verbose and counter % plot_every == 0:
                     # Plotting intermediate results
-                    metrics = Metrics()
+                    metrics = self._metrics
                     # --Random samples from the model
                     points_to_plot, sample_pz = self._session.run(
-                        [self._generated, self._noise],
+                        [self._plot_generated, self._plot_noise],
                         feed_dict={
-                            self._noise_ph: self._noise_for_plots[0:num_plot],
                             self._is_training_ph: False,
                             self._keep_prob_ph: 1e5})
                     Qz_num = 320
@@ -1841,7 +2103,6 @@ class ImagePot(Pot):
                         self._Qz,
                         feed_dict={
                             self._real_points_ph: self._data.data[:Qz_num],
-                            self._enc_noise_ph: utils.generate_noise(opts, Qz_num),
                             self._is_training_ph: False,
                             self._keep_prob_ph: 1e5})
                     # Searching least Gaussian 2d projection
@@ -1855,6 +2116,7 @@ class ImagePot(Pot):
                     else:
                         metrics.Qz_labels = None
                     metrics.l2s = losses[:]
+                    metrics.l2s_steps = losses_steps[:]
                     metrics.losses_match = [opts['pot_lambda'] * el for el in losses_match]
                     metrics.losses_rec = [opts['reconstr_w'] * el for el in losses_rec]
                     to_plot = [points_to_plot, 0 * batch_images[:16], batch_images]
@@ -1875,18 +2137,12 @@ class ImagePot(Pot):
                         [self._reconstruct_x, self._real_points],
                         feed_dict={
                             self._real_points_ph: self._data.data[:num_real_p],
-                            self._enc_noise_ph: utils.generate_noise(opts, num_real_p),
                             self._is_training_ph: True,
                             self._keep_prob_ph: 1e5})
                     points = real_p
-                    merged = np.vstack([reconstructed, points])
-                    r_ptr = 0
-                    w_ptr = 0
-                    for _ in range(8 * 10):
-                        merged[w_ptr] = points[r_ptr]
-                        merged[w_ptr + 1] = reconstructed[r_ptr]
-                        r_ptr += 1
-                        w_ptr += 2
+                    merged = self._merged_buf
+                    merged[0::2] = points[:8 * 10]
+                    merged[1::2] = reconstructed[:8 * 10]
                     metrics.make_plots(
                         opts,
                         counter,
@@ -1895,7 +2151,6 @@ class ImagePot(Pot):
                         prefix='reconstr_e%04d_mb%05d_' % (_epoch, _idx))
                     sample_prev = points_to_plot[:]
         if _epoch > 0:
-            os.path.join(opts['work_dir'], opts['ckpt_dir'])
             self._saver.save(self._session,
                              os.path.join(opts['work_dir'],
                                           opts['ckpt_dir'],
@@ -0,0 +1,31 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Graph construction checks for POT.
+
+"""
+import unittest
+import tensorflow as tf
+import ops
+from pot import ImagePot
+
+
+class DataAugmentationTest(unittest.TestCase):
+
+    def test_augmented_points_keep_static_shape(self):
+        opts = {'data_augm': True, 'init_std': 0.0099999,
+                'init_bias': 0.0, 'conv_filters_dim': 4}
+        # Only _data_augmentation is needed, skip building the session
+        pot = ImagePot.__new__(ImagePot)
+        with tf.Graph().as_default():
+            real_points = tf.placeholder(tf.float32, [None, 32, 32, 3])
+            is_training = tf.placeholder(tf.bool, [])
+            points = pot._data_augmentation(opts, real_points, is_training)
+            self.assertEqual(points.get_shape().as_list(), [None, 32, 32, 3])
+            # Variables of the encoder need the number of input channels
+            ops.conv2d(opts, points, 8, scope='h0_conv')
+
+
+if __name__ == '__main__':
+    unittest.main()
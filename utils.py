@@ -19,20 +19,21 @@ import metrics as metrics_lib
 # from metrics import Metrics
 from tqdm import tqdm
 
-def generate_noise(opts, num=100):
-    """Generate latent noise.
+def generate_noise(opts, num=100, scale=1.):
+    """Generate latent noise, multiplied by scale.
     """
     noise = None
     if opts['latent_space_distr'] == 'uniform':
         noise = np.random.uniform(
-            -1, 1, [num, opts["latent_space_dim"]]).astype(np.float32)
+            -scale, scale, [num, opts["latent_space_dim"]]).astype(np.float32)
     elif opts['latent_space_distr'] == 'normal':
-        mean = np.zeros(opts["latent_space_dim"])
-        cov = np.identity(opts["latent_space_dim"])
-        noise = np.random.multivariate_normal(
-            mean, cov, num).astype(np.float32)
+        # Same as multivariate_normal with identity covariance but
+        # without factorizing the covariance every call
+        noise = np.random.normal(
+            0., scale, [num, opts["latent_space_dim"]]).astype(np.float32)
     elif opts['latent_space_distr'] == 'mnist':
-        noise = np.random.rand(1, opts['latent_space_dim'])
+        noise = scale * np.random.rand(
+            1, opts['latent_space_dim']).astype(np.float32)
     return noise
 
 class ArraySaver(object):